@@ -0,0 +1,363 @@
+import collections
+import hashlib
+import sqlite3
+
+from toc import get_toc_order
+
+
+CATALOG_FILENAME = 'beckhoff_catalog.sqlite3'
+
+# Bump when the schema changes: the catalog is rebuilt from the sources (and
+# ID maps) on the next run rather than migrated
+SCHEMA_VERSION = 2
+
+TABLES = ('packages', 'topics', 'metadata', 'links', 'assets', 'files',
+          'confluence_pages')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS packages (
+    name TEXT PRIMARY KEY,
+    archive_hash TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS topics (
+    package TEXT NOT NULL,
+    id TEXT NOT NULL,
+    source_path TEXT NOT NULL,
+    title TEXT,
+    parent_id TEXT,
+    toc_order INTEGER,
+    source_hash TEXT,
+    PRIMARY KEY (package, id)
+);
+CREATE INDEX IF NOT EXISTS topics_id ON topics (id);
+CREATE INDEX IF NOT EXISTS topics_source_path ON topics (source_path);
+CREATE INDEX IF NOT EXISTS topics_parent
+    ON topics (package, parent_id, toc_order);
+CREATE TABLE IF NOT EXISTS metadata (
+    package TEXT NOT NULL,
+    topic_id TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT
+);
+CREATE INDEX IF NOT EXISTS metadata_topic ON metadata (package, topic_id);
+CREATE INDEX IF NOT EXISTS metadata_key_value ON metadata (key, value);
+CREATE TABLE IF NOT EXISTS links (
+    package TEXT NOT NULL,
+    topic_id TEXT NOT NULL,
+    href TEXT NOT NULL,
+    target_id TEXT
+);
+CREATE INDEX IF NOT EXISTS links_topic ON links (package, topic_id);
+CREATE INDEX IF NOT EXISTS links_target ON links (target_id);
+CREATE TABLE IF NOT EXISTS assets (
+    package TEXT NOT NULL,
+    topic_id TEXT NOT NULL,
+    src TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS assets_topic ON assets (package, topic_id);
+CREATE INDEX IF NOT EXISTS assets_src ON assets (src);
+CREATE TABLE IF NOT EXISTS files (
+    package TEXT NOT NULL,
+    source_path TEXT NOT NULL,
+    PRIMARY KEY (package, source_path)
+);
+CREATE TABLE IF NOT EXISTS confluence_pages (
+    package TEXT NOT NULL,
+    topic_id TEXT NOT NULL,
+    confluence_id INTEGER NOT NULL,
+    PRIMARY KEY (package, topic_id)
+);
+CREATE INDEX IF NOT EXISTS confluence_pages_id
+    ON confluence_pages (confluence_id);
+'''
+
+
+def hash_file(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_references(tree):
+    'Outgoing link hrefs and image sources of a topic tree'
+    links = [el.get('href')
+             for el in (tree.findall('.//a', namespaces=tree.nsmap) +
+                        tree.findall('.//link', namespaces=tree.nsmap))
+             if el.get('href')]
+    assets = [img.get('src')
+              for img in tree.findall('.//img', namespaces=tree.nsmap)
+              if img.get('src')]
+    return links, assets
+
+
+def get_link_target(href):
+    'Help ID referenced by an MS Help link, if any'
+    if '?Id=' in href:
+        return href.split('?Id=', 1)[1]
+    return None
+
+
+def topics_from_sources(source_by_id):
+    'Catalog topics for write_package from MSHC ``source_by_id`` entries'
+    for info in source_by_id.values():
+        links, assets = get_references(info['tree'])
+        yield {
+            'id': info['id'],
+            'source_path': info['source_path'],
+            'title': info['metadata'].get('Title', [None])[0],
+            'parent': info['parent'],
+            'order': get_toc_order(info['metadata']),
+            'source_hash': info['source_hash'],
+            'metadata': info['metadata'],
+            'links': [(href, get_link_target(href)) for href in links],
+            'assets': assets,
+        }
+
+
+class Catalog:
+    '''
+    Indexed SQLite catalog of converted help topics
+
+    Holds, per package, each topic's metadata, TOC parent, outgoing links and
+    image references, along with the non-topic files of the archive and the
+    Confluence page IDs of published topics.  Packages are rewritten in a
+    single transaction by write_package.
+
+    Topics are keyed by package and help ID, as the same ID may appear in more
+    than one package.  Queries search every package unless one is given;
+    per-topic lookups raise ValueError if the ID is ambiguous.
+    '''
+
+    def __init__(self, path=CATALOG_FILENAME):
+        self.path = path
+        self.connection = sqlite3.connect(str(path))
+        version, = self.connection.execute('PRAGMA user_version').fetchone()
+        if version != SCHEMA_VERSION:
+            with self.connection as conn:
+                for table in TABLES:
+                    conn.execute(f'DROP TABLE IF EXISTS {table}')
+        self.connection.executescript(SCHEMA)
+        self.connection.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+    def __repr__(self):
+        return f'<Catalog {self.path}>'
+
+    def close(self):
+        self.connection.close()
+
+    def _ids(self, query, *params):
+        return [row[0] for row in self.connection.execute(query, params)]
+
+    def _packages_of(self, topic_id, package):
+        'Resolve the package of a topic, where it was not given'
+        if package is not None:
+            return package
+
+        packages = self._ids('SELECT package FROM topics WHERE id = ?',
+                             topic_id)
+        if len(packages) > 1:
+            raise ValueError(f'Topic {topic_id} is in several packages '
+                             f'({", ".join(packages)}); pass package=')
+        return packages[0] if packages else None
+
+    def get_package_hash(self, package):
+        row = self.connection.execute(
+            'SELECT archive_hash FROM packages WHERE name = ?', (package, )
+        ).fetchone()
+        return row[0] if row else None
+
+    def write_package(self, package, archive_hash, topics, files=()):
+        '''
+        Replace everything stored for ``package``
+
+        ``topics`` are dictionaries with keys ``id``, ``source_path``,
+        ``title``, ``parent``, ``order``, ``source_hash``, ``metadata`` (key
+        to value or list of values), ``links`` (list of ``(href, target_id)``)
+        and ``assets`` (list of image sources).  ``files`` are the archive
+        paths of everything which is not a topic.  Topic IDs must be unique
+        within the package.
+        '''
+        topics = list(topics)
+        counts = collections.Counter(topic['id'] for topic in topics)
+        duplicates = sorted(id_ for id_, count in counts.items() if count > 1)
+        if duplicates:
+            raise ValueError(f'Duplicate topic IDs in {package}: {duplicates}')
+
+        with self.connection as conn:
+            for table in ('topics', 'metadata', 'links', 'assets', 'files'):
+                conn.execute(f'DELETE FROM {table} WHERE package = ?',
+                             (package, ))
+
+            conn.executemany(
+                'INSERT INTO topics VALUES (?, ?, ?, ?, ?, ?, ?)',
+                ((package, topic['id'], topic['source_path'], topic['title'],
+                  topic['parent'], topic['order'], topic['source_hash'])
+                 for topic in topics))
+            conn.executemany(
+                'INSERT INTO metadata VALUES (?, ?, ?, ?)',
+                ((package, topic['id'], key, str(value))
+                 for topic in topics
+                 for key, values in topic['metadata'].items()
+                 for value in (values if isinstance(values, list)
+                               else [values])))
+            conn.executemany(
+                'INSERT INTO links VALUES (?, ?, ?, ?)',
+                ((package, topic['id'], href, target_id)
+                 for topic in topics
+                 for href, target_id in topic['links']))
+            conn.executemany(
+                'INSERT INTO assets VALUES (?, ?, ?)',
+                ((package, topic['id'], src)
+                 for topic in topics
+                 for src in topic['assets']))
+            conn.executemany(
+                'INSERT OR IGNORE INTO files VALUES (?, ?)',
+                ((package, source_path) for source_path in files))
+            conn.execute('INSERT OR REPLACE INTO packages VALUES (?, ?)',
+                         (package, archive_hash))
+
+    def load_topics(self, package):
+        'Topics of a package, in the form given to write_package'
+        topics = {}
+        for row in self.connection.execute(
+                'SELECT id, source_path, title, parent_id, toc_order, '
+                'source_hash FROM topics WHERE package = ? ORDER BY rowid',
+                (package, )):
+            topic_id, source_path, title, parent, order, source_hash = row
+            topics[topic_id] = {'id': topic_id,
+                                'source_path': source_path,
+                                'title': title,
+                                'parent': parent,
+                                'order': order,
+                                'source_hash': source_hash,
+                                'metadata': collections.defaultdict(list),
+                                'links': [],
+                                'assets': [],
+                                }
+
+        for topic_id, key, value in self.connection.execute(
+                'SELECT topic_id, key, value FROM metadata '
+                'WHERE package = ? ORDER BY rowid', (package, )):
+            topics[topic_id]['metadata'][key].append(value)
+        for topic_id, href, target_id in self.connection.execute(
+                'SELECT topic_id, href, target_id FROM links '
+                'WHERE package = ? ORDER BY rowid', (package, )):
+            topics[topic_id]['links'].append((href, target_id))
+        for topic_id, src in self.connection.execute(
+                'SELECT topic_id, src FROM assets '
+                'WHERE package = ? ORDER BY rowid', (package, )):
+            topics[topic_id]['assets'].append(src)
+
+        for topic in topics.values():
+            topic['metadata'] = dict(topic['metadata'])
+        return list(topics.values())
+
+    def load_files(self, package):
+        return self._ids('SELECT source_path FROM files WHERE package = ?',
+                         package)
+
+    def find_by_path(self, prefix, package=None):
+        'IDs of topics whose archive path starts with ``prefix``'
+        # A range query (rather than LIKE) so that the index is used
+        return self._ids(
+            'SELECT DISTINCT id FROM topics '
+            'WHERE source_path >= ? AND source_path < ? '
+            'AND (? IS NULL OR package = ?) ORDER BY source_path',
+            prefix, prefix + '\U0010ffff', package, package)
+
+    def find_by_metadata(self, key, value, package=None):
+        return self._ids(
+            'SELECT DISTINCT topic_id FROM metadata WHERE key = ? AND value = ? '
+            'AND (? IS NULL OR package = ?)',
+            key, value, package, package)
+
+    def get_metadata(self, topic_id, package=None):
+        package = self._packages_of(topic_id, package)
+        metadata = collections.defaultdict(list)
+        for key, value in self.connection.execute(
+                'SELECT key, value FROM metadata '
+                'WHERE package = ? AND topic_id = ? ORDER BY rowid',
+                (package, topic_id)):
+            metadata[key].append(value)
+        return dict(metadata)
+
+    def get_children(self, topic_id, package=None):
+        package = self._packages_of(topic_id, package)
+        return self._ids(
+            'SELECT id FROM topics WHERE package = ? AND parent_id = ? '
+            'ORDER BY toc_order, id', package, topic_id)
+
+    def get_links_to(self, topic_id, package=None):
+        'IDs of topics which link to ``topic_id``'
+        return self._ids(
+            'SELECT DISTINCT topic_id FROM links WHERE target_id = ? '
+            'AND (? IS NULL OR package = ?)', topic_id, package, package)
+
+    def get_links_from(self, topic_id, package=None):
+        package = self._packages_of(topic_id, package)
+        return self._ids(
+            'SELECT DISTINCT target_id FROM links '
+            'WHERE package = ? AND topic_id = ? AND target_id IS NOT NULL',
+            package, topic_id)
+
+    def get_link_targets(self, package):
+        'Help IDs linked to by each topic of a package'
+        targets = collections.defaultdict(list)
+        for topic_id, target_id in self.connection.execute(
+                'SELECT DISTINCT topic_id, target_id FROM links '
+                'WHERE package = ? AND target_id IS NOT NULL '
+                'ORDER BY topic_id, target_id', (package, )):
+            targets[topic_id].append(target_id)
+        return dict(targets)
+
+    def get_topic_references(self, package, topic_id=None):
+        '''
+        Outgoing links and image sources of the topics of a package
+
+        Returns ``{topic_id: {'links': [(href, target_id), ...], 'assets':
+        [src, ...]}}``, for one topic only if ``topic_id`` is given.
+        '''
+        references = collections.defaultdict(
+            lambda: {'links': [], 'assets': []})
+        for topic_id_, href, target_id in self.connection.execute(
+                'SELECT topic_id, href, target_id FROM links '
+                'WHERE package = ? AND (? IS NULL OR topic_id = ?) '
+                'ORDER BY rowid', (package, topic_id, topic_id)):
+            references[topic_id_]['links'].append((href, target_id))
+        for topic_id_, src in self.connection.execute(
+                'SELECT topic_id, src FROM assets '
+                'WHERE package = ? AND (? IS NULL OR topic_id = ?) '
+                'ORDER BY rowid', (package, topic_id, topic_id)):
+            references[topic_id_]['assets'].append(src)
+        return dict(references)
+
+    def get_topics_using_asset(self, src, package=None):
+        return self._ids(
+            'SELECT DISTINCT topic_id FROM assets WHERE src = ? '
+            'AND (? IS NULL OR package = ?)', src, package, package)
+
+    def get_confluence_id(self, topic_id, package=None):
+        package = self._packages_of(topic_id, package)
+        row = self.connection.execute(
+            'SELECT confluence_id FROM confluence_pages '
+            'WHERE package = ? AND topic_id = ?', (package, topic_id)
+        ).fetchone()
+        return row[0] if row else None
+
+    def get_topic_by_confluence_id(self, confluence_id):
+        'The ``(package, topic_id)`` published as a Confluence page'
+        row = self.connection.execute(
+            'SELECT package, topic_id FROM confluence_pages '
+            'WHERE confluence_id = ?', (int(confluence_id), )).fetchone()
+        return tuple(row) if row else None
+
+    def set_confluence_ids(self, package, beckhoff_to_confluence):
+        with self.connection as conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO confluence_pages VALUES (?, ?, ?)',
+                ((package, beckhoff_id, int(confluence_id))
+                 for beckhoff_id, confluence_id
+                 in beckhoff_to_confluence.items()
+                 if confluence_id is not None))
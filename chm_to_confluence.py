@@ -12,6 +12,12 @@ import zipfile
 
 from confluence import client
 
+from catalog import Catalog, get_references
+from reconcile import (check_reconciled, match_pages, reconcile_space,
+                       report_duplicates, save_id_map)
+from render import RenderCache, hash_source, render_all
+from toc import NO_NODE, TocTree
+
 
 chm_file = sys.argv[1]
 if chm_file.lower().endswith('.chm'):
@@ -21,6 +27,9 @@ chm_short_name = os.path.splitext(os.path.split(chm_file)[-1])[0]
 beckhoff_to_confluence_fn = f'{chm_short_name}.map.json'
 
 extracted_path = pathlib.Path(sys.argv[2])
+render_cache = RenderCache(f'{chm_short_name}.render_cache')
+# Confluence ID -> {'title': ..., 'version': ...}, filled in by reconcile()
+current_versions = {}
 
 space_key = 'SBI'
 
@@ -78,12 +87,11 @@ class HelpItem:
             title = self.beckhoff_id
 
         self.title = f'{title} ({beckhoff_id})'
-        self.children = []
         self.parent = parent
 
     def __repr__(self):
-        return (f'<HelpItem {self.beckhoff_id} ({self.confluence_id}) {self.title!r} '
-                f'children={len(self.children)}>')
+        return (f'<HelpItem {self.beckhoff_id} ({self.confluence_id}) '
+                f'{self.title!r}>')
 
 
 def get_order(path, fn='index.hhc'):
@@ -95,9 +103,11 @@ def get_order(path, fn='index.hhc'):
 
 
 def find_by_path(path):
-    path = str(path)
-    return [s for s in source_by_id.values()
-            if str(s['dest_path']).startswith(path)]
+    'Help items whose filename starts with ``path``'
+    return [hier[toc.index_by_id[beckhoff_id]]
+            for beckhoff_id in catalog.find_by_path(str(path),
+                                                    package=chm_short_name)
+            if beckhoff_id in toc.index_by_id]
 
 
 def get_id(doc):
@@ -106,6 +116,20 @@ def get_id(doc):
     return f'{chm_short_name}_{doc}'
 
 
+def get_unique_files(files):
+    'Drop files listed again in the TOC (or sharing an ID), keeping the first'
+    seen = set()
+    unique = []
+    for fn in files:
+        beckhoff_id = get_id(fn)
+        if beckhoff_id in seen:
+            print(f'Skipping {fn} - {beckhoff_id} is already in the TOC')
+            continue
+        seen.add(beckhoff_id)
+        unique.append(fn)
+    return unique
+
+
 def get_title(tree):
     return tree.findall('.//title', namespaces=tree.nsmap)[0].text
 
@@ -118,16 +142,25 @@ def wrap_html(html):
 '''.format(html)
 
 
-def build_page(item, dry_run=True):
-    pg = c.get_content_by_id(
-        content_id=item.confluence_id,
-        expand=['extensions', 'space', 'body', 'body.view', 'history',
-                'version'])
+def get_render_tasks(items):
+    # A page depends on the ID map only through its own page ID and those of
+    # the files it links to, so only those entries go into its hash
+    by_file = beckhoff_to_confluence['by_file']
+    tasks = []
+    for item in items:
+        links, _ = get_references(item.tree)
+        used_ids = {href: by_file[href] for href in links if href in by_file}
+        tasks.append((item.beckhoff_id,
+                      hash_source(item.contents, item.confluence_id, used_ids)))
+    return tasks
+
 
-    if pg.space.key != space_key:
-        raise ValueError(f'Unexpected space: {pg.space.key}')
+def render_page(task):
+    beckhoff_id, source_hash = task
+    item = hier[toc.index_by_id[beckhoff_id]]
 
     tree = copy.deepcopy(item.tree)
+    attachments = {}
     images = tree.findall('.//img', namespaces=tree.nsmap)
     for img in images:
         src = img.get('src')
@@ -138,16 +171,7 @@ def build_page(item, dry_run=True):
             assert os.path.exists(fn)
             remote_fn = os.path.split(fn)[-1]
             img.set('src', f'/download/attachments/{item.confluence_id}/{remote_fn}')
-            if dry_run:
-                print('attach to', item.confluence_id, 'file', fn, 'remote=',
-                      remote_fn)
-            else:
-                try:
-                    c.add_attachment(content_id=item.confluence_id, file_path=fn,
-                                     file_name=remote_fn)
-                except client.ConfluenceError:
-                    # c.update_attachment()
-                    print('TODO', fn)
+            attachments[remote_fn] = {'file_name': remote_fn, 'path': fn}
 
     links = (tree.findall('.//a', namespaces=tree.nsmap) +
              tree.findall('.//link', namespaces=tree.nsmap)
@@ -158,60 +182,180 @@ def build_page(item, dry_run=True):
             link.set('href',
                      rewrite_link_for_confluence(href, beckhoff_to_confluence))
 
+    render_cache.store_page(
+        beckhoff_id, source_hash, confluence_id=item.confluence_id,
+        body=wrap_html(lxml.etree.tostring(tree).decode('utf-8')),
+        attachments=list(attachments.values()),
+    )
+    return beckhoff_id
+
+
+def render_pages(tasks, processes=None):
+    missing = [task for task in tasks if not render_cache.has_page(*task)]
+    print(f'Rendering {len(missing)} of {len(tasks)} pages')
+    for i, _ in enumerate(render_all(render_page, missing,
+                                     processes=processes)):
+        if (i % 1000) == 0:
+            print('Rendered', i, 'pages')
+
+
+def get_current_version(confluence_id):
+    if confluence_id not in current_versions:
+        pg = c.get_content_by_id(content_id=confluence_id,
+                                 expand=['space', 'version'])
+
+        if pg.space.key != space_key:
+            raise ValueError(f'Unexpected space: {pg.space.key}')
+
+        current_versions[confluence_id] = {'title': pg.title,
+                                           'version': pg.version.number,
+                                           }
+    return current_versions[confluence_id]
+
+
+def publish_page(payload, dry_run=True):
+    confluence_id = payload['confluence_id']
+    current = get_current_version(confluence_id)
+
+    for attachment in payload['attachments']:
+        if dry_run:
+            print('attach to', confluence_id, 'file', attachment['path'],
+                  'remote=', attachment['file_name'])
+        else:
+            try:
+                c.add_attachment(content_id=confluence_id,
+                                 file_path=attachment['path'],
+                                 file_name=attachment['file_name'])
+            except client.ConfluenceError:
+                # c.update_attachment()
+                print('TODO', attachment['path'])
+
     # Content properties are created in create_outline
-    # c.create_content_property(pg.id, 'beckhoff', source_md['metadata'])
+    # c.create_content_property(confluence_id, 'beckhoff', source_md['metadata'])
 
-    new_content = wrap_html(lxml.etree.tostring(tree).decode('utf-8'))
+    new_content = payload['body']
     if dry_run:
-        print('content', pg.id, new_content)
+        print('content', confluence_id, new_content)
     else:
         c.update_content(
-            content_id=pg.id,
+            content_id=confluence_id,
             content_type=client.ContentType.PAGE,
-            new_version=pg.version.number + 1,
-            new_title=pg.title,  # source_md['metadata']['Title'],
+            new_version=current['version'] + 1,
+            new_title=current['title'],  # source_md['metadata']['Title'],
             new_content=new_content,
         )
+        current['version'] += 1
 
 
-def create_outline(item):
-    parent = item.parent
-    parent_id = (parent.confluence_id if parent else None)
-    if item.confluence_id is None:
-        content = c.create_content(
-            client.ContentType.PAGE, title=item.title, space_key=space_key,
-            content='', parent_content_id=parent_id)
-        item.confluence_id = content.id
-        beckhoff_to_confluence['by_id'][item.beckhoff_id] = item.confluence_id
-        beckhoff_to_confluence['by_file'][item.filename] = item.confluence_id
-
-    try:
-        c.create_content_property(item.confluence_id, 'beckhoff', item.metadata)
-    except client.ConfluenceVersionConflict:
-        ...
+def build_page(item, dry_run=True):
+    task, = get_render_tasks([item])
+    if not render_cache.has_page(*task):
+        render_page(task)
+
+    publish_page(render_cache.load_page(*task), dry_run=dry_run)
+
+
+def create_outline(toc, items, start=NO_NODE):
+    # Pre-order traversal: parents are always created before their children
+    for idx, _ in toc.iter_dfs(start):
+        item = items[idx]
+        parent = item.parent
+        parent_id = (parent.confluence_id if parent else None)
+        if item.confluence_id is None:
+            content = c.create_content(
+                client.ContentType.PAGE, title=item.title, space_key=space_key,
+                content='', parent_content_id=parent_id)
+            item.confluence_id = content.id
+            beckhoff_to_confluence['by_id'][item.beckhoff_id] = item.confluence_id
+            beckhoff_to_confluence['by_file'][item.filename] = item.confluence_id
 
-    for child in item.children:
-        create_outline(child)
+        try:
+            c.create_content_property(item.confluence_id, 'beckhoff',
+                                      item.metadata)
+        except client.ConfluenceVersionConflict:
+            ...
 
-def walk(item):
-    yield item
-    for child in item.children:
-        yield from walk(child)
+    catalog.set_confluence_ids(chm_short_name,
+                               beckhoff_to_confluence['by_id'])
 
 
-def get_id_map(hier):
-    return {item.beckhoff_id: item.confluence_id
-            for top in hier
-            for item in walk(top)
+def get_id_map(toc, items):
+    return {items[idx].beckhoff_id: items[idx].confluence_id
+            for idx, _ in toc.iter_dfs()
             }
 
 
-def build_all(dry_run=True):
+def get_catalog_topics():
+    filenames = set(files)
+    for idx, item in enumerate(hier):
+        links, assets = get_references(item.tree)
+        parent = item.parent
+        yield {
+            'id': item.beckhoff_id,
+            'source_path': item.filename,
+            'title': item.title,
+            'parent': parent.beckhoff_id if parent else None,
+            'order': idx,
+            'source_hash': hash_source(item.contents),
+            'metadata': item.metadata,
+            'links': [(href, get_id(href) if href in filenames else None)
+                      for href in links],
+            'assets': assets,
+        }
+
+
+def write_catalog():
+    topics = list(get_catalog_topics())
+    package_hash = hash_source(*(topic['source_hash'] for topic in topics))
+    catalog.write_package(chm_short_name, package_hash, topics)
+    catalog.set_confluence_ids(chm_short_name,
+                               beckhoff_to_confluence['by_id'])
+
+
+def build_all(dry_run=True, processes=None):
+    # Render everything up front; a failed publish can then be re-run without
+    # re-rendering, as pages are only rebuilt when their sources or the page
+    # IDs they use change
+    tasks = get_render_tasks(hier)
+    render_pages(tasks, processes=processes)
+    for task in tasks:
+        publish_page(render_cache.load_page(*task), dry_run=dry_run)
+
+
+def reconcile(force=False):
+    '''
+    Update the ID map and version table from the pages in the space
+
+    Pages are matched to help items by the ``beckhoff`` content property set
+    in create_outline.  Matches are merged into the existing map, which is
+    only saved (keeping a ``.bak`` of the old file) if enough items were
+    found; see check_reconciled.
+    '''
+    properties, versions = reconcile_space(c, space_key)
+
+    found_by_id, duplicates = match_pages(properties, 'beckhoff-id',
+                                          toc.index_by_id)
+    report_duplicates(duplicates)
+    found_by_file = {properties[confluence_id]['filename']: confluence_id
+                     for confluence_id in found_by_id.values()}
+
+    print(f'Found {len(found_by_id)} of {len(hier)} items '
+          f'in {len(versions)} pages')
+    check_reconciled(found_by_id, len(beckhoff_to_confluence['by_id']),
+                     force=force)
+
+    current_versions.update(versions)
+    beckhoff_to_confluence['by_id'].update(found_by_id)
+    beckhoff_to_confluence['by_file'].update(found_by_file)
     for item in hier:
-        build_page(item, dry_run=dry_run)
+        item.confluence_id = beckhoff_to_confluence['by_id'].get(item.beckhoff_id)
 
+    save_id_map(beckhoff_to_confluence_fn, beckhoff_to_confluence)
+    catalog.set_confluence_ids(chm_short_name,
+                               beckhoff_to_confluence['by_id'])
 
-files = get_order(extracted_path)
+
+files = get_unique_files(get_order(extracted_path))
 try:
     with open(beckhoff_to_confluence_fn, 'rt') as f:
         beckhoff_to_confluence = json.load(f)
@@ -224,12 +368,19 @@ hier = [HelpItem(get_id(fn), filename=fn,
                  confluence_id=beckhoff_to_confluence['by_file'].get(fn))
         for fn in files]
 
-# Make the first one the parent of all
+# Make the first one the parent of all, keeping the index.hhc order
 root = hier[0]
-root.children = hier[1:]
-for child in root.children:
+for child in hier[1:]:
     child.parent = root
 
+toc = TocTree(ids=[item.beckhoff_id for item in hier],
+              parent_ids=[item.parent.beckhoff_id if item.parent else None
+                          for item in hier],
+              orders=range(len(hier)))
+
+catalog = Catalog()
+write_catalog()
+
 # import confluence.models.content
 # c.delete_content(child.confluence_id, confluence.models.content.ContentStatus.CURRENT)
 
@@ -240,7 +391,8 @@ c = client.Confluence(
 
 
 c.__enter__()
-# create_outline(root)
+# reconcile(force=False)
+# create_outline(toc, hier)
 # build_all(dry_run=True)
 # with open(beckhoff_to_confluence_fn, 'wt') as f:
 #     json.dump(beckhoff_to_confluence, f)
@@ -6,12 +6,17 @@ import pathlib
 import sys
 import zipfile
 
+from catalog import Catalog, hash_file, topics_from_sources
+from render import hash_source
+from toc import TocTree
+
 output_path = pathlib.Path(sys.argv[1])
 mshc_file = sys.argv[2]  #  'bkinfosys3_vs_100_en-us.mshc'
 
 source_extensions = {'.htm', '.html'}
 source_by_id = {}
 special_paths = {}
+other_files = []
 
 
 def get_dest_path(source_path, relative_to=None):
@@ -53,59 +58,38 @@ def parse_html(html_path, contents):
 
 
 def build_index_hierarchy():
-    hierarchy = {}
-    index = []
-
-    items = list(sorted((id_, info['parent'])
-                        for id_, info in source_by_id.items()))
-    grouped_by_parent = collections.defaultdict(list)
-
-    for id_, parent in items:
-        grouped_by_parent[parent].append(id_)
-
-    top_levels = [id_ for id_, parent in items
-                  if parent not in source_by_id]
-
-    def build(parents, parent_dict, depth):
-        parent_id = parents[-1]
-        index.append(parents)
-
-        this_dict = {}
-        parent_dict[parent_id] = this_dict
-        for child_id in grouped_by_parent[parent_id]:
-            build(parents + [child_id], this_dict, depth=depth + 1)
-
-    for top in top_levels:
-        build([top], hierarchy, depth=0)
-
-    return hierarchy, index
-
-
-def create_index(index_lines):
-    indexed = []
-    for ids in index_lines:
-        info = source_by_id[ids[-1]]
-        dest_path = info['dest_path']
-        try:
-            title = info['metadata']['Title'][0]
-        except KeyError:
-            title = str(dest_path)
-
-        try:
-            desc = info['metadata']['Description'][0]
-        except KeyError:
-            desc = ''
-        else:
-            if desc == title:
-                desc = ''
+    return TocTree.from_source_by_id(source_by_id)
+
+
+def write_catalog():
+    catalog = Catalog()
+    catalog.write_package(os.path.basename(mshc_file), hash_file(mshc_file),
+                          topics_from_sources(source_by_id),
+                          files=other_files)
+    catalog.close()
 
-        indexed.append((ids, title, desc, str(dest_path.relative_to(output_path))))
 
+def create_index(toc):
     with open(output_path / 'index.html', 'wt') as f:
-        for ids, title, desc, dest_path in sorted(indexed):
-            depth = len(ids)
+        for idx, depth in toc.iter_dfs():
+            info = source_by_id[toc.ids[idx]]
+            dest_path = info['dest_path']
+            try:
+                title = info['metadata']['Title'][0]
+            except KeyError:
+                title = str(dest_path)
+
+            try:
+                desc = info['metadata']['Description'][0]
+            except KeyError:
+                desc = ''
+            else:
+                if desc == title:
+                    desc = ''
+
+            dest_path = str(dest_path.relative_to(output_path))
             print(
-                '&nbsp;' * depth,
+                '&nbsp;' * (depth + 1),
                 f'<a title={desc!r} href={dest_path!r}>{title}</a>',
                 f'<br />', file=f)
 
@@ -126,6 +110,8 @@ with zipfile.ZipFile(mshc_file, 'r') as zf:
 
             source_id = metadata['Microsoft.Help.Id'][0]
             source_by_id[source_id] = {
+                'source_path': source_path,
+                'source_hash': hash_source(contents),
                 'dest_path': dest_path,
                 'tree': tree,
                 'id': source_id,
@@ -135,6 +121,7 @@ with zipfile.ZipFile(mshc_file, 'r') as zf:
 
             continue
 
+        other_files.append(source_path)
         if dest_path.parent == output_path:
             special_paths[source_path] = dest_path
 
@@ -143,6 +130,9 @@ with zipfile.ZipFile(mshc_file, 'r') as zf:
             df.write(contents)
 
 
+# Catalog the sources before links are rewritten for the output below
+write_catalog()
+
 for source_id, info in source_by_id.items():
     tree = info['tree']
 
@@ -171,5 +161,5 @@ for source_id, info in source_by_id.items():
         df.write(contents)
 
 
-hier, index = build_index_hierarchy()
-create_index(index)
+toc = build_index_hierarchy()
+create_index(toc)
@@ -11,6 +11,12 @@ import zipfile
 
 from confluence import client
 
+from catalog import Catalog, hash_file, topics_from_sources
+from reconcile import (check_reconciled, match_pages, reconcile_space,
+                       report_duplicates, save_id_map)
+from render import RenderCache, hash_source, render_all
+from toc import NO_NODE, TocTree
+
 
 output_path = pathlib.Path(sys.argv[1])
 mshc_file = sys.argv[2]  #  'bkinfosys3_vs_100_en-us.mshc'
@@ -21,7 +27,15 @@ source_extensions = {'.htm', '.html'}
 source_by_id = {}
 special_paths = {}
 assets_by_path = {}
+# Archive paths of assets, when loaded from the catalog rather than the archive
+asset_sources = {}
+other_files = []
+open_archives = {}
 SHARED_ATTACHMENT_ID = 245718672
+beckhoff_to_confluence_fn = 'beckhoff_to_confluence.json'
+# Confluence ID -> {'title': ..., 'version': ...}, filled in by reconcile()
+current_versions = {}
+render_cache = RenderCache(output_path / 'render_cache')
 
 
 def get_dest_path(source_path, relative_to=None):
@@ -59,6 +73,9 @@ def rewrite_link_for_confluence(source_path, beckhoff_to_confluence):
 
     if '?Id=' in source_path:
         _, doc_id = source_path.split('?Id=', 1)
+        if doc_id not in beckhoff_to_confluence:
+            print('No page for link target', doc_id)
+            return source_path
         confluence_id = beckhoff_to_confluence[doc_id]
         return f'/pages/viewpage.action?pageId={confluence_id}'
     elif source_path in special_paths:
@@ -96,105 +113,117 @@ class HelpItem:
             self.title = str(beckhoff_id)
 
         self.title = f'{self.title} ({beckhoff_id})'
-        self.children = []
         self.parent = parent
 
 
 def build_index_hierarchy():
-    items = list(sorted((id_, info['parent'])
-                        for id_, info in source_by_id.items()))
-    grouped_by_parent = collections.defaultdict(list)
+    toc = TocTree.from_source_by_id(source_by_id)
+    items = [HelpItem(id_, source_by_id[id_]) for id_ in toc.ids]
+    for item, parent_idx in zip(items, toc.parent):
+        if parent_idx != NO_NODE:
+            item.parent = items[parent_idx]
 
-    for id_, parent in items:
-        grouped_by_parent[parent].append(id_)
+    return toc, items
 
-    top_levels = [HelpItem(id_, source_by_id[id_])
-                  for id_, parent in items
-                  if parent not in source_by_id]
 
-    def build(parent):
-        for child_id in grouped_by_parent[parent.beckhoff_id]:
-            child = HelpItem(child_id, source_by_id[child_id], parent=parent)
-            parent.children.append(child)
-            build(child)
+def load_from_archive():
+    with zipfile.ZipFile(mshc_file, 'r') as zf:
+        for finfo in zf.filelist:
+            source_path = finfo.filename
+            suffix = pathlib.Path(source_path).suffix
+            dest_path = pathlib.Path(get_dest_path(source_path))
 
-    for top in top_levels:
-        build(top)
+            with zf.open(finfo, 'r') as f:
+                contents = f.read()
 
-    return top_levels
+            if suffix in source_extensions:
+                contents = contents.decode('utf-8')
 
+                metadata, tree = parse_html(dest_path, contents)
 
-with zipfile.ZipFile(mshc_file, 'r') as zf:
-    for finfo in zf.filelist:
-        source_path = finfo.filename
-        suffix = pathlib.Path(source_path).suffix
-        dest_path = pathlib.Path(get_dest_path(source_path))
+                source_id = metadata['Microsoft.Help.Id'][0]
+                source_by_id[source_id] = {
+                    'source_path': source_path,
+                    'dest_path': dest_path,
+                    'tree': tree,
+                    'source_hash': hash_source(contents),
+                    'id': source_id,
+                    'parent': metadata.get('Microsoft.Help.TOCParent', [None])[0],
+                    'metadata': metadata,
+                }
 
-        with zf.open(finfo, 'r') as f:
-            contents = f.read()
+                continue
 
-        if suffix in source_extensions:
-            contents = contents.decode('utf-8')
+            other_files.append(source_path)
+            if dest_path.parent == output_path:
+                special_paths[source_path] = dest_path
 
-            metadata, tree = parse_html(dest_path, contents)
+            # os.makedirs(dest_path.parent, exist_ok=True)
+            # with open(dest_path, 'wb') as df:
+            #     df.write(contents)
+            assets_by_path[dest_path] = contents
 
-            source_id = metadata['Microsoft.Help.Id'][0]
-            source_by_id[source_id] = {
-                'dest_path': dest_path,
-                'tree': tree,
-                'id': source_id,
-                'parent': metadata.get('Microsoft.Help.TOCParent', [None])[0],
-                'metadata': metadata,
-            }
-
-            continue
 
+def load_from_catalog():
+    # Trees and asset contents are read from the archive only when rendering
+    for source_path in catalog.load_files(package):
+        dest_path = pathlib.Path(get_dest_path(source_path))
+        asset_sources[dest_path] = source_path
         if dest_path.parent == output_path:
             special_paths[source_path] = dest_path
 
-        # os.makedirs(dest_path.parent, exist_ok=True)
-        # with open(dest_path, 'wb') as df:
-        #     df.write(contents)
-        assets_by_path[dest_path] = contents
+    for topic in catalog.load_topics(package):
+        dest_path = pathlib.Path(get_dest_path(topic['source_path']))
+        metadata = topic['metadata']
+        metadata['parent_path'] = dest_path
+        source_by_id[topic['id']] = {
+            'source_path': topic['source_path'],
+            'dest_path': dest_path,
+            'source_hash': topic['source_hash'],
+            'id': topic['id'],
+            'parent': topic['parent'],
+            'metadata': metadata,
+        }
 
 
-def find_by_path(path):
-    path = str(path)
-    return [s for s in source_by_id.values()
-            if str(s['dest_path']).startswith(path)]
+def read_archive(source_path):
+    # One handle per process, as forked render workers must not share the
+    # file offset of an archive opened by their parent
+    pid = os.getpid()
+    if pid not in open_archives:
+        open_archives[pid] = zipfile.ZipFile(mshc_file, 'r')
+    return open_archives[pid].read(source_path)
 
 
-for source_id, info in source_by_id.items():
-    tree = info['tree']
+def get_tree(info):
+    if 'tree' not in info:
+        contents = read_archive(info['source_path']).decode('utf-8')
+        _, info['tree'] = parse_html(info['dest_path'], contents)
+    return info['tree']
 
-    parent_path = info['dest_path'].parent
 
-    # images = tree.findall('.//img', namespaces=tree.nsmap)
-    # for img in images:
-    #     src = img.get('src')
-    #     if src:
-    #         img.set('src', str(get_dest_path(src, parent_path)))
+def get_asset(dest_path):
+    if dest_path in assets_by_path:
+        return assets_by_path[dest_path]
+    return read_archive(asset_sources[dest_path])
 
-    # links = (tree.findall('.//a', namespaces=tree.nsmap) +
-    #          tree.findall('.//link', namespaces=tree.nsmap)
-    #          )
 
-    # for link in links:
-    #     href = link.get('href')
-    #     if href:
-    #         new_href = str(get_dest_path(href, parent_path))
-    #         link.set('href', new_href)
-
-    # contents = lxml.etree.tostring(tree)
-    # os.makedirs(parent_path, exist_ok=True)
-
-    # with open(info['dest_path'], 'wb') as df:
-    #     df.write(contents)
-    # assets_by_path[info['dest_path']] = contents
+def find_by_path(path):
+    'Sources whose archive path starts with ``path``'
+    return [source_by_id[source_id]
+            for source_id in catalog.find_by_path(str(path), package=package)
+            if source_id in source_by_id]
 
 
-hier = build_index_hierarchy()
-# create_index(index)
+catalog = Catalog()
+package = os.path.basename(mshc_file)
+archive_hash = hash_file(mshc_file)
+if catalog.get_package_hash(package) == archive_hash:
+    load_from_catalog()
+else:
+    load_from_archive()
+    catalog.write_package(package, archive_hash,
+                          topics_from_sources(source_by_id), files=other_files)
 
 
 def wrap_html(html):
@@ -215,36 +244,69 @@ def get_md_for_confluence(md):
     return {key: get_value(value) for key, value in md.items()}
 
 
-def build_page(beckhoff_to_confluence, confluence_id):
-    confluence_to_beckhoff = dict((v, k) for k, v in beckhoff_to_confluence.items())
-    beckhoff_id = confluence_to_beckhoff[confluence_id]
-    source_md = source_by_id[beckhoff_id]
+toc, hier = build_index_hierarchy()
+# create_index(index)
 
-    pg = c.get_content_by_id(
-        content_id=confluence_id,
-        expand=['extensions', 'space', 'body', 'body.view', 'history',
-                'version'])
 
-    if pg.space.key != space_key:
-        raise ValueError(f'Unexpected space: {pg.space.key}')
+def get_asset_crcs():
+    # The central directory has a checksum of every archive member, so this
+    # does not read the assets themselves
+    with zipfile.ZipFile(mshc_file, 'r') as zf:
+        return {finfo.filename: finfo.CRC for finfo in zf.infolist()}
+
+
+def get_render_task(beckhoff_id, references, asset_crcs,
+                    beckhoff_to_confluence):
+    # Everything render_page reads besides the topic itself goes into the
+    # hash: the page IDs of the page and its link targets, which links point
+    # at shared attachments, and the contents of the images it uses
+    links = references.get('links', [])
+    used_ids = {target_id: beckhoff_to_confluence.get(target_id)
+                for _, target_id in links if target_id is not None}
+    used_ids[beckhoff_id] = beckhoff_to_confluence[beckhoff_id]
+    inputs = {
+        'source_hash': source_by_id[beckhoff_id]['source_hash'],
+        'page_ids': used_ids,
+        'shared_links': sorted({href for href, _ in links
+                                if href in special_paths}),
+        'shared_attachment_id': SHARED_ATTACHMENT_ID,
+        'assets': {src: asset_crcs.get(src.lower().lstrip('/'))
+                   for src in references.get('assets', [])},
+    }
+    return (beckhoff_id, hash_source(inputs))
+
+
+def get_render_tasks(beckhoff_to_confluence):
+    references = catalog.get_topic_references(package)
+    asset_crcs = get_asset_crcs()
+    tasks = []
+    for beckhoff_id in beckhoff_to_confluence:
+        if beckhoff_id not in source_by_id:
+            print('Skipping', beckhoff_id, '- not in', package)
+            continue
+        tasks.append(get_render_task(beckhoff_id,
+                                     references.get(beckhoff_id, {}),
+                                     asset_crcs, beckhoff_to_confluence))
+    return tasks
+
 
-    tree = copy.deepcopy(source_md['tree'])
+def render_page(task):
+    beckhoff_id, source_hash = task
+    confluence_id = beckhoff_to_confluence[beckhoff_id]
+    source_md = source_by_id[beckhoff_id]
+
+    tree = copy.deepcopy(get_tree(source_md))
+    attachments = {}
     images = tree.findall('.//img', namespaces=tree.nsmap)
     for img in images:
         src = img.get('src')
         if src:
             fn = os.path.split(img.get('src'))[-1]
             img.set('src', f'/download/attachments/{confluence_id}/{fn}')
-            with open(fn, 'wb') as f:
+            if fn not in attachments:
                 key = output_path / src.lower().lstrip('/')
-                f.write(assets_by_path[key])
-
-            try:
-                c.add_attachment(content_id=confluence_id, file_path=fn,
-                                 file_name=fn)
-            except client.ConfluenceError:
-                # c.update_attachment()
-                print('TODO', fn)
+                attachments[fn] = render_cache.store_attachment(
+                    fn, get_asset(key))
 
     links = (tree.findall('.//a', namespaces=tree.nsmap) +
              tree.findall('.//link', namespaces=tree.nsmap)
@@ -255,57 +317,144 @@ def build_page(beckhoff_to_confluence, confluence_id):
             link.set('href',
                      rewrite_link_for_confluence(href, beckhoff_to_confluence))
 
+    render_cache.store_page(
+        beckhoff_id, source_hash, confluence_id=confluence_id,
+        body=wrap_html(lxml.etree.tostring(tree).decode('utf-8')),
+        attachments=list(attachments.values()),
+    )
+    return beckhoff_id
+
+
+def render_pages(tasks, processes=None):
+    missing = [task for task in tasks if not render_cache.has_page(*task)]
+    print(f'Rendering {len(missing)} of {len(tasks)} pages')
+    for i, _ in enumerate(render_all(render_page, missing,
+                                     processes=processes)):
+        if (i % 1000) == 0:
+            print('Rendered', i, 'pages')
+
+
+def get_current_version(confluence_id):
+    if confluence_id not in current_versions:
+        pg = c.get_content_by_id(content_id=confluence_id,
+                                 expand=['space', 'version'])
+
+        if pg.space.key != space_key:
+            raise ValueError(f'Unexpected space: {pg.space.key}')
+
+        current_versions[confluence_id] = {'title': pg.title,
+                                           'version': pg.version.number,
+                                           }
+    return current_versions[confluence_id]
+
+
+def publish_page(payload):
+    confluence_id = payload['confluence_id']
+    current = get_current_version(confluence_id)
+
+    for attachment in payload['attachments']:
+        try:
+            c.add_attachment(content_id=confluence_id,
+                             file_path=attachment['path'],
+                             file_name=attachment['file_name'])
+        except client.ConfluenceError:
+            # c.update_attachment()
+            print('TODO', attachment['file_name'])
+
     # Content properties are created in create_outline
-    # c.create_content_property(pg.id, 'beckhoff',
+    # c.create_content_property(confluence_id, 'beckhoff',
     #                           get_md_for_confluence(source_md['metadata']))
 
     c.update_content(
-        content_id=pg.id,
+        content_id=confluence_id,
         content_type=client.ContentType.PAGE,
-        new_version=pg.version.number + 1,
-        new_title=pg.title,  # source_md['metadata']['Title'],
-        new_content=wrap_html(lxml.etree.tostring(tree).decode('utf-8')),
+        new_version=current['version'] + 1,
+        new_title=current['title'],  # source_md['metadata']['Title'],
+        new_content=payload['body'],
     )
+    current['version'] += 1
+
+
+def build_page(beckhoff_to_confluence, confluence_id):
+    confluence_to_beckhoff = dict((v, k) for k, v in beckhoff_to_confluence.items())
+    beckhoff_id = confluence_to_beckhoff[confluence_id]
+    references = catalog.get_topic_references(package, beckhoff_id)
+    task = get_render_task(beckhoff_id, references.get(beckhoff_id, {}),
+                           get_asset_crcs(), beckhoff_to_confluence)
+    if not render_cache.has_page(*task):
+        render_page(task)
+
+    publish_page(render_cache.load_page(*task))
+
+
+def create_outline(toc, items, start=NO_NODE):
+    # Pre-order traversal: parents are always created before their children
+    for idx, _ in toc.iter_dfs(start):
+        item = items[idx]
+        parent = item.parent
+        parent_id = (parent.confluence_id if parent else None)
+        if item.confluence_id is None:
+            content = c.create_content(
+                client.ContentType.PAGE, title=item.title, space_key=space_key,
+                content='', parent_content_id=parent_id)
+            item.confluence_id = content.id
+
+        try:
+            c.create_content_property(item.confluence_id, 'beckhoff',
+                                      item.metadata)
+        except client.ConfluenceVersionConflict:
+            ...
+
+    catalog.set_confluence_ids(package, get_id_map(toc, items))
+
+
+def get_id_map(toc, items):
+    return {items[idx].beckhoff_id: items[idx].confluence_id
+            for idx, _ in toc.iter_dfs()
+            }
 
 
-def create_outline(item):
-    parent = item.parent
-    parent_id = (parent.confluence_id if parent else None)
-    if item.confluence_id is None:
-        content = c.create_content(
-            client.ContentType.PAGE, title=item.title, space_key=space_key,
-            content='', parent_content_id=parent_id)
-        item.confluence_id = content.id
+def build_all(processes=None):
+    # Render everything up front; a failed publish can then be re-run without
+    # re-rendering, as pages are only rebuilt when their sources or the page
+    # IDs they use change
+    tasks = get_render_tasks(beckhoff_to_confluence)
+    render_pages(tasks, processes=processes)
 
-    try:
-        c.create_content_property(item.confluence_id, 'beckhoff', item.metadata)
-    except client.ConfluenceVersionConflict:
-        ...
+    for i, task in enumerate(tasks):
+        if (i % 1000) == 0:
+            for j in range(20):
+                print('----------------------', i)
 
-    for child in item.children:
-        create_outline(child)
+        publish_page(render_cache.load_page(*task))
 
 
-def walk(item):
-    yield item
-    for child in item.children:
-        yield from walk(child)
+def reconcile(force=False):
+    '''
+    Update the ID map and version table from the pages in the space
 
+    Pages are matched to topics by the ``beckhoff`` content property set in
+    create_outline.  Matches are merged into the existing map, which is only
+    saved (keeping a ``.bak`` of the old file) if enough topics were found;
+    see check_reconciled.
+    '''
+    properties, versions = reconcile_space(c, space_key)
 
-def get_id_map(hier):
-    return {item.beckhoff_id: item.confluence_id
-            for top in hier
-            for item in walk(top)
-            }
+    found, duplicates = match_pages(properties, 'Microsoft.Help.Id',
+                                    source_by_id)
+    report_duplicates(duplicates)
 
+    print(f'Found {len(found)} of {len(source_by_id)} topics '
+          f'in {len(versions)} pages')
+    check_reconciled(found, len(beckhoff_to_confluence), force=force)
 
-def build_all():
-    for i, (beckhoff_id, confluence_id) in enumerate(beckhoff_to_confluence.items()):
-        if (i % 1000) == 0:
-            for j in range(20):
-                print('----------------------', i)
+    current_versions.update(versions)
+    beckhoff_to_confluence.update(found)
+    for item in hier:
+        item.confluence_id = beckhoff_to_confluence.get(item.beckhoff_id)
 
-        build_page(beckhoff_to_confluence, confluence_id=confluence_id)
+    save_id_map(beckhoff_to_confluence_fn, beckhoff_to_confluence)
+    catalog.set_confluence_ids(package, beckhoff_to_confluence)
 
 
 c = client.Confluence(
@@ -316,10 +465,15 @@ c = client.Confluence(
 
 c.__enter__()
 
-with open('beckhoff_to_confluence.json', 'rt') as f:
-    beckhoff_to_confluence = json.load(f)
+try:
+    with open(beckhoff_to_confluence_fn, 'rt') as f:
+        beckhoff_to_confluence = json.load(f)
+except FileNotFoundError:
+    beckhoff_to_confluence = {}
+
+# reconcile(force=False)
 
-# source_md, = find_by_path('bkhf-confluence/tf8810_tc3_aes70/1033/index.html')
+# source_md, = find_by_path('tf8810_tc3_aes70/1033/index.html')
 # build_page(245717810, source_md)
 # c.update_content_property(
 #     pg.id, 'beckhoff-page', beckhoff_id, pg.version.number + 2,
@@ -0,0 +1,130 @@
+import collections
+import json
+import os
+import shutil
+
+
+PROPERTY_KEY = 'beckhoff'
+PAGE_LIMIT = 1000
+# Refuse to replace an ID map with one matching fewer than this fraction of
+# its entries, unless forced
+MIN_MATCH_FRACTION = 0.5
+
+
+def iter_space_pages(c, space_key, *, property_key=PROPERTY_KEY,
+                     limit=PAGE_LIMIT):
+    '''
+    Yield every page in the space, with version and content property expanded
+
+    ``Confluence.search`` does not take a page size, leaving the server
+    default of 25, so the paginated search is driven directly with ``limit``
+    set on the first request.  The client then follows the ``next`` links,
+    which carry the limit along (the server clamps it to its own maximum).
+    Pages are yielded as the raw JSON of the search results.
+    '''
+    return c._get_paged_results(
+        dict, 'content/search',
+        {'cql': f'space = "{space_key}" and type = page',
+         'limit': str(limit),
+         },
+        ['version', f'metadata.properties.{property_key}'],
+    )
+
+
+def get_content_property(content, key):
+    try:
+        return content['metadata']['properties'][key]['value']
+    except (KeyError, TypeError):
+        return None
+
+
+def reconcile_space(c, space_key, *, property_key=PROPERTY_KEY,
+                    limit=PAGE_LIMIT):
+    '''
+    List the space, returning content properties and current page versions
+
+    Returns ``(properties, versions)``, both keyed by (integer) Confluence
+    page ID.  ``properties`` only holds pages which have the content property
+    set; ``versions`` holds ``{'title': ..., 'version': ...}`` for every page,
+    which is what an update needs without re-fetching the page.
+    '''
+    properties = {}
+    versions = {}
+    for content in iter_space_pages(c, space_key, property_key=property_key,
+                                    limit=limit):
+        content_id = int(content['id'])
+        versions[content_id] = {'title': content['title'],
+                                'version': content['version']['number'],
+                                }
+        value = get_content_property(content, property_key)
+        if value is not None:
+            properties[content_id] = value
+
+    return properties, versions
+
+
+def get_property_id(metadata, key):
+    '''
+    Help ID stored under ``key`` in a content property value
+
+    get_md_for_confluence stores a multi-valued key as a list, in which case
+    the first value is used.
+    '''
+    value = metadata.get(key) if isinstance(metadata, dict) else None
+    if isinstance(value, list):
+        value = value[0] if value else None
+    return value if isinstance(value, str) else None
+
+
+def match_pages(properties, key, known_ids):
+    '''
+    Match pages to known help IDs by their content property
+
+    Returns ``(found, duplicates)``: ``found`` maps help ID to page ID and
+    ``duplicates`` maps each help ID carried by more than one page to all of
+    them.  Of duplicates, the lowest (oldest) page ID is the one kept.
+    '''
+    pages_by_id = collections.defaultdict(list)
+    for confluence_id, metadata in sorted(properties.items()):
+        beckhoff_id = get_property_id(metadata, key)
+        if beckhoff_id in known_ids:
+            pages_by_id[beckhoff_id].append(confluence_id)
+
+    found = {beckhoff_id: pages[0]
+             for beckhoff_id, pages in pages_by_id.items()}
+    duplicates = {beckhoff_id: pages
+                  for beckhoff_id, pages in pages_by_id.items()
+                  if len(pages) > 1}
+    return found, duplicates
+
+
+def report_duplicates(duplicates):
+    for beckhoff_id, pages in sorted(duplicates.items()):
+        print(f'{beckhoff_id} is on several pages {pages}; using {pages[0]}')
+
+
+def check_reconciled(found, previous_count, *, force=False):
+    '''
+    Raise ValueError if ``found`` should not replace an ID map
+
+    An empty result always is, as that is what a missing property expansion
+    or a mismatched property key looks like.  A result much smaller than the
+    existing map is only accepted with ``force``.
+    '''
+    if not found:
+        raise ValueError('No pages matched by content property; '
+                         'not updating the ID map')
+    if not force and len(found) < MIN_MATCH_FRACTION * previous_count:
+        raise ValueError(f'Only {len(found)} pages matched where the ID map has '
+                         f'{previous_count}; use force=True to update anyway')
+
+
+def save_id_map(filename, id_map):
+    'Write an ID map, keeping the previous file as ``<filename>.bak``'
+    if os.path.exists(filename):
+        shutil.copyfile(filename, f'{filename}.bak')
+
+    tmp_filename = f'{filename}.tmp'
+    with open(tmp_filename, 'wt') as f:
+        json.dump(id_map, f)
+    os.replace(tmp_filename, filename)
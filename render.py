@@ -0,0 +1,106 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import pathlib
+
+
+def hash_source(*parts):
+    'Digest of page inputs: raw source text/bytes or JSON-serializable state'
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+        elif not isinstance(part, bytes):
+            part = json.dumps(part, sort_keys=True, default=str).encode('utf-8')
+        digest.update(part)
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class RenderCache:
+    '''
+    On-disk store of pre-rendered Confluence page payloads
+
+    Pages are keyed by Beckhoff ID and the hash of everything that went into
+    rendering them, so a payload is only rebuilt when its inputs change.
+    Attachments are stored once by content hash and referenced from the page
+    manifests.
+    '''
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+        self.page_path = self.path / 'pages'
+        self.attachment_path = self.path / 'attachments'
+        os.makedirs(self.page_path, exist_ok=True)
+        os.makedirs(self.attachment_path, exist_ok=True)
+
+    def __repr__(self):
+        return f'<RenderCache {self.path}>'
+
+    def page_filename(self, beckhoff_id, source_hash):
+        return self.page_path / f'{beckhoff_id}.{source_hash}.json'
+
+    def has_page(self, beckhoff_id, source_hash):
+        return self.page_filename(beckhoff_id, source_hash).exists()
+
+    def load_page(self, beckhoff_id, source_hash):
+        with open(self.page_filename(beckhoff_id, source_hash), 'rt') as f:
+            return json.load(f)
+
+    def store_page(self, beckhoff_id, source_hash, *, confluence_id, body,
+                   attachments):
+        payload = {'beckhoff_id': beckhoff_id,
+                   'confluence_id': confluence_id,
+                   'source_hash': source_hash,
+                   'body': body,
+                   'attachments': attachments,
+                   }
+        self._write(self.page_filename(beckhoff_id, source_hash),
+                    json.dumps(payload).encode('utf-8'))
+        return payload
+
+    def store_attachment(self, file_name, contents):
+        'Store attachment contents, returning its manifest entry'
+        path = self.attachment_path / hash_source(contents) / file_name
+        if not path.exists():
+            os.makedirs(path.parent, exist_ok=True)
+            self._write(path, contents)
+        return {'file_name': file_name, 'path': str(path)}
+
+    def _write(self, path, contents):
+        # Write then rename, so an interrupted render never leaves a partial
+        # payload that would later be mistaken for a complete one
+        tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(contents)
+        os.replace(tmp_path, path)
+
+
+_render_func = None
+
+
+def _call_render_func(task):
+    return _render_func(task)
+
+
+def render_all(render_func, tasks, *, processes=None, chunksize=8):
+    '''
+    Run render_func over tasks in a pool of worker processes
+
+    Workers are forked so that they share the already-parsed sources of the
+    calling script rather than having them pickled per task; render_func is
+    inherited the same way, so it need not be importable.  Results are yielded
+    as they complete.
+
+    Where fork is not available (Windows), tasks are rendered in-process.
+    '''
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        yield from map(render_func, tasks)
+        return
+
+    global _render_func
+    _render_func = render_func
+    ctx = multiprocessing.get_context('fork')
+    with ctx.Pool(processes) as pool:
+        yield from pool.imap_unordered(_call_render_func, tasks, chunksize)
@@ -0,0 +1,158 @@
+import lxml.etree
+import pytest
+
+from catalog import Catalog, get_link_target, topics_from_sources
+
+
+def make_topic(topic_id, parent=None, order=0, links=(), assets=(),
+               metadata=None, source_path=None):
+    return {'id': topic_id,
+            'source_path': source_path or f'pkg/{topic_id}.htm',
+            'title': f'Title {topic_id}',
+            'parent': parent,
+            'order': order,
+            'source_hash': f'hash-{topic_id}',
+            'metadata': metadata or {'Title': [f'Title {topic_id}']},
+            'links': [(f'ms-xhelp:///?Id={target}', target)
+                      for target in links],
+            'assets': list(assets),
+            }
+
+
+@pytest.fixture
+def catalog():
+    catalog = Catalog(':memory:')
+    catalog.write_package('P1', 'archive-1', [
+        make_topic('root', links=['b']),
+        make_topic('b', parent='root', order=2, links=['a', 'root'],
+                   assets=['/img/x.png']),
+        make_topic('a', parent='root', order=1, assets=['/img/x.png'],
+                   source_path='other/a.htm'),
+    ], files=['style.css'])
+    yield catalog
+    catalog.close()
+
+
+def test_get_link_target():
+    assert get_link_target('ms-xhelp:///?Id=abc') == 'abc'
+    assert get_link_target('http://example.com') is None
+
+
+def test_topics_from_sources():
+    tree = lxml.etree.fromstring(
+        '<html><body><a href="ms-xhelp:///?Id=b">b</a>'
+        '<a href="http://example.com">x</a><img src="/img/x.png"/>'
+        '</body></html>')
+    source_by_id = {'a': {'id': 'a',
+                          'source_path': 'pkg/a.htm',
+                          'parent': 'root',
+                          'source_hash': 'hash-a',
+                          'metadata': {'Title': ['Title a'],
+                                       'Microsoft.Help.TOCOrder': ['3']},
+                          'tree': tree,
+                          }}
+    assert list(topics_from_sources(source_by_id)) == [{
+        'id': 'a',
+        'source_path': 'pkg/a.htm',
+        'title': 'Title a',
+        'parent': 'root',
+        'order': 3,
+        'source_hash': 'hash-a',
+        'metadata': source_by_id['a']['metadata'],
+        'links': [('ms-xhelp:///?Id=b', 'b'), ('http://example.com', None)],
+        'assets': ['/img/x.png'],
+    }]
+
+
+def test_queries(catalog):
+    assert catalog.get_package_hash('P1') == 'archive-1'
+    assert catalog.get_package_hash('P2') is None
+    assert catalog.find_by_path('pkg/') == ['b', 'root']
+    assert catalog.find_by_path('other/') == ['a']
+    assert catalog.get_children('root') == ['a', 'b']
+    assert sorted(catalog.get_links_to('root')) == ['b']
+    assert sorted(catalog.get_links_from('b')) == ['a', 'root']
+    assert catalog.get_link_targets('P1') == {'b': ['a', 'root'],
+                                              'root': ['b']}
+    assert sorted(catalog.get_topics_using_asset('/img/x.png')) == ['a', 'b']
+    assert catalog.find_by_metadata('Title', 'Title a') == ['a']
+    assert catalog.get_metadata('a') == {'Title': ['Title a']}
+    assert catalog.load_files('P1') == ['style.css']
+
+
+def test_get_topic_references(catalog):
+    references = catalog.get_topic_references('P1')
+    assert references['b'] == {
+        'links': [('ms-xhelp:///?Id=a', 'a'), ('ms-xhelp:///?Id=root', 'root')],
+        'assets': ['/img/x.png'],
+    }
+    assert references['root'] == {'links': [('ms-xhelp:///?Id=b', 'b')],
+                                  'assets': []}
+    assert list(catalog.get_topic_references('P1', 'a')) == ['a']
+    assert catalog.get_topic_references('P2') == {}
+
+
+def test_load_topics_round_trip(catalog):
+    topics = {topic['id']: topic for topic in catalog.load_topics('P1')}
+    assert topics['b'] == make_topic('b', parent='root', order=2,
+                                     links=['a', 'root'],
+                                     assets=['/img/x.png'])
+
+
+def test_rewrite_replaces_package(catalog):
+    catalog.write_package('P1', 'archive-2', [make_topic('root')])
+    assert catalog.get_package_hash('P1') == 'archive-2'
+    assert [topic['id'] for topic in catalog.load_topics('P1')] == ['root']
+    assert catalog.get_links_to('root') == []
+    assert catalog.get_topics_using_asset('/img/x.png') == []
+    assert catalog.load_files('P1') == []
+
+
+def test_same_id_in_two_packages(catalog):
+    catalog.write_package('P2', 'archive-3', [
+        make_topic('a', metadata={'k': ['v']})])
+
+    assert [topic['id'] for topic in catalog.load_topics('P1')] == [
+        'root', 'b', 'a']
+    assert catalog.get_metadata('a', package='P1') == {'Title': ['Title a']}
+    assert catalog.get_metadata('a', package='P2') == {'k': ['v']}
+    with pytest.raises(ValueError):
+        catalog.get_metadata('a')
+
+    catalog.write_package('P2', 'archive-3', [
+        make_topic('a', metadata={'k': ['v']})])
+    assert catalog.get_metadata('a', package='P2') == {'k': ['v']}
+    assert catalog.find_by_path('pkg/a') == ['a']
+    assert catalog.find_by_path('pkg/a', package='P1') == []
+
+
+def test_duplicate_ids_rejected(catalog):
+    with pytest.raises(ValueError):
+        catalog.write_package('P1', 'archive-2',
+                              [make_topic('x'), make_topic('x')])
+    assert catalog.get_package_hash('P1') == 'archive-1'
+
+
+def test_confluence_ids(catalog):
+    assert catalog.get_confluence_id('a') is None
+    catalog.set_confluence_ids('P1', {'a': 5, 'b': '6', 'root': None})
+    assert catalog.get_confluence_id('a') == 5
+    assert catalog.get_confluence_id('b') == 6
+    assert catalog.get_confluence_id('root') is None
+    assert catalog.get_topic_by_confluence_id(6) == ('P1', 'b')
+    assert catalog.get_topic_by_confluence_id('5') == ('P1', 'a')
+    # Published IDs survive the package being rewritten
+    catalog.write_package('P1', 'archive-2', [make_topic('a')])
+    assert catalog.get_confluence_id('a') == 5
+
+
+def test_old_schema_is_rebuilt(tmp_path):
+    path = tmp_path / 'catalog.sqlite3'
+    catalog = Catalog(path)
+    catalog.connection.execute('PRAGMA user_version = 1')
+    catalog.write_package('P1', 'archive-1', [make_topic('a')])
+    catalog.close()
+
+    catalog = Catalog(path)
+    assert catalog.get_package_hash('P1') is None
+    catalog.close()
@@ -0,0 +1,113 @@
+import json
+
+import pytest
+
+from reconcile import (check_reconciled, get_content_property, match_pages,
+                       reconcile_space, save_id_map)
+
+
+class StubConfluence:
+    'Paged search with the signatures of confluence-rest-library 1.2.2'
+    default_limit = 25
+
+    def __init__(self, results):
+        self.results = results
+        self.requests = []
+
+    def search(self, cql, cql_context=None, expand=None):
+        params = {'cql': cql}
+        return self._get_paged_results(dict, 'content/search', params, expand)
+
+    def _get_paged_results(self, item_type, path, params, expand):
+        if expand:
+            params['expand'] = ','.join(expand)
+
+        start = 0
+        limit = int(params.get('limit', self.default_limit))
+        while path != '':
+            self.requests.append((path, dict(params)))
+            page = self.results[start:start + limit]
+            start += limit
+            if start < len(self.results):
+                # The real client follows _links.next, which keeps the limit
+                path = f'content/search?start={start}&limit={limit}'
+                params.clear()
+            else:
+                path = ''
+
+            for result in page:
+                yield item_type(result)
+
+
+def make_page(content_id, beckhoff_id=None):
+    page = {'id': str(content_id),
+            'title': f'Page {content_id}',
+            'version': {'number': 3},
+            'metadata': {'properties': {}},
+            }
+    if beckhoff_id is not None:
+        page['metadata']['properties']['beckhoff'] = {
+            'key': 'beckhoff',
+            'value': {'Microsoft.Help.Id': beckhoff_id},
+        }
+    return page
+
+
+def test_reconcile_space_pages_with_large_limit():
+    results = [make_page(i, f'b{i}' if i % 2 else None) for i in range(2500)]
+    c = StubConfluence(results)
+    properties, versions = reconcile_space(c, 'SBI', limit=1000)
+
+    assert len(c.requests) == 3
+    path, params = c.requests[0]
+    assert path == 'content/search'
+    assert params['limit'] == '1000'
+    assert params['cql'] == 'space = "SBI" and type = page'
+    assert set(params['expand'].split(',')) == {
+        'version', 'metadata.properties.beckhoff'}
+
+    assert len(versions) == 2500
+    assert versions[7] == {'title': 'Page 7', 'version': 3}
+    assert len(properties) == 1250
+    assert properties[7] == {'Microsoft.Help.Id': 'b7'}
+
+
+def test_get_content_property_missing():
+    assert get_content_property({}, 'beckhoff') is None
+    assert get_content_property(make_page(1), 'beckhoff') is None
+
+
+def test_match_pages():
+    properties = {5: {'Microsoft.Help.Id': ['a', 'a2']},
+                  3: {'Microsoft.Help.Id': 'b'},
+                  2: {'Microsoft.Help.Id': 'b'},
+                  4: {'Microsoft.Help.Id': []},
+                  6: {'Microsoft.Help.Id': 'unknown'},
+                  7: 'not a dict',
+                  }
+    found, duplicates = match_pages(properties, 'Microsoft.Help.Id',
+                                    {'a': 0, 'b': 1})
+    assert found == {'a': 5, 'b': 2}
+    assert duplicates == {'b': [2, 3]}
+
+
+def test_check_reconciled():
+    with pytest.raises(ValueError):
+        check_reconciled({}, 0)
+    with pytest.raises(ValueError):
+        check_reconciled({}, 10, force=True)
+    with pytest.raises(ValueError):
+        check_reconciled({'a': 1}, 10)
+    check_reconciled({'a': 1}, 10, force=True)
+    check_reconciled({'a': 1, 'b': 2}, 3)
+
+
+def test_save_id_map_keeps_backup(tmp_path):
+    filename = str(tmp_path / 'map.json')
+    save_id_map(filename, {'a': 1})
+    save_id_map(filename, {'a': 1, 'b': 2})
+
+    with open(filename) as f:
+        assert json.load(f) == {'a': 1, 'b': 2}
+    with open(f'{filename}.bak') as f:
+        assert json.load(f) == {'a': 1}
@@ -0,0 +1,71 @@
+import multiprocessing
+import os
+
+from render import RenderCache, hash_source, render_all
+
+
+def test_hash_source():
+    assert hash_source('abc') == hash_source(b'abc')
+    assert hash_source('a', 'bc') != hash_source('ab', 'c')
+    assert hash_source({'a': 1, 'b': 2}) == hash_source({'b': 2, 'a': 1})
+    assert hash_source({'a': 1}) != hash_source({'a': 2})
+
+
+def test_page_round_trip(tmp_path):
+    cache = RenderCache(tmp_path)
+    assert not cache.has_page('id1', 'h1')
+
+    attachment = cache.store_attachment('img.png', b'png')
+    cache.store_page('id1', 'h1', confluence_id=5, body='<p/>',
+                     attachments=[attachment])
+
+    assert cache.has_page('id1', 'h1')
+    assert not cache.has_page('id1', 'h2')
+    payload = cache.load_page('id1', 'h1')
+    assert payload == {'beckhoff_id': 'id1',
+                       'confluence_id': 5,
+                       'source_hash': 'h1',
+                       'body': '<p/>',
+                       'attachments': [attachment],
+                       }
+    with open(attachment['path'], 'rb') as f:
+        assert f.read() == b'png'
+    assert not list(tmp_path.glob('**/*.tmp'))
+
+
+def test_attachments_stored_by_content(tmp_path):
+    cache = RenderCache(tmp_path)
+    first = cache.store_attachment('img.png', b'one')
+    assert cache.store_attachment('img.png', b'one') == first
+    second = cache.store_attachment('img.png', b'two')
+    assert second['file_name'] == 'img.png'
+    assert second['path'] != first['path']
+
+
+def test_render_all(tmp_path):
+    cache = RenderCache(tmp_path)
+
+    # A closure: not importable, so it must reach the workers by fork
+    def render(task):
+        beckhoff_id, source_hash = task
+        cache.store_page(beckhoff_id, source_hash, confluence_id=None,
+                         body=str(os.getpid()), attachments=[])
+        return beckhoff_id
+
+    tasks = [(f'id{i}', hash_source(i)) for i in range(20)]
+    assert sorted(render_all(render, tasks, processes=2)) == sorted(
+        beckhoff_id for beckhoff_id, _ in tasks)
+    assert all(cache.has_page(*task) for task in tasks)
+    assert {cache.load_page(*task)['body'] for task in tasks} != {
+        str(os.getpid())}
+
+
+def test_render_all_without_fork(monkeypatch):
+    monkeypatch.setattr(multiprocessing, 'get_all_start_methods',
+                        lambda: ['spawn'])
+
+    def render(task):
+        return task, os.getpid()
+
+    assert list(render_all(render, [1, 2, 3])) == [
+        (1, os.getpid()), (2, os.getpid()), (3, os.getpid())]
@@ -0,0 +1,94 @@
+import random
+
+import pytest
+
+from toc import NO_NODE, NO_ORDER, TocTree, get_toc_order
+
+
+def recursive_dfs(tree, idx, depth=0):
+    yield idx, depth
+    for child in tree.children(idx):
+        yield from recursive_dfs(tree, child, depth + 1)
+
+
+def random_tree(count, seed):
+    rng = random.Random(seed)
+    ids = [f'id{i}' for i in range(count)]
+    parents = [None] + [ids[rng.randrange(i)] for i in range(1, count)]
+    orders = [rng.randrange(5) for _ in range(count)]
+    return TocTree(ids, parents, orders)
+
+
+def ids_of(tree, nodes):
+    return [(tree.ids[idx], depth) for idx, depth in nodes]
+
+
+def test_children_ordered_by_toc_order_then_id():
+    tree = TocTree(['root', 'b', 'a', 'c'], [None, 'root', 'root', 'root'],
+                   [0, 1, 1, 0])
+    assert [tree.ids[idx] for idx in tree.children(0)] == ['c', 'a', 'b']
+
+
+def test_unknown_and_self_parents_are_roots():
+    tree = TocTree(['a', 'b', 'c'], ['missing', 'b', 'a'])
+    assert [tree.ids[idx] for idx in tree.roots()] == ['a', 'b']
+    assert tree.parent[tree.index_by_id['c']] == tree.index_by_id['a']
+
+
+def test_dfs_and_bfs():
+    tree = TocTree(['a', 'b', 'c', 'd', 'e'], [None, 'a', 'a', 'b', None],
+                   [0, 2, 1, 0, 1])
+    assert ids_of(tree, tree.iter_dfs()) == [
+        ('a', 0), ('c', 1), ('b', 1), ('d', 2), ('e', 0)]
+    assert ids_of(tree, tree.iter_bfs()) == [
+        ('a', 0), ('e', 0), ('c', 1), ('b', 1), ('d', 2)]
+
+
+def test_subtree_traversal():
+    tree = TocTree(['a', 'b', 'c', 'd'], [None, 'a', 'b', 'a'], [0, 0, 0, 1])
+    b = tree.index_by_id['b']
+    assert ids_of(tree, tree.iter_dfs(b)) == [('b', 0), ('c', 1)]
+    assert ids_of(tree, tree.iter_bfs(b)) == [('b', 0), ('c', 1)]
+    c = tree.index_by_id['c']
+    assert ids_of(tree, tree.iter_dfs(c)) == [('c', 0)]
+    assert [tree.ids[idx] for idx in tree.ancestors(c)] == ['a', 'b', 'c']
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_dfs_matches_recursive_reference(seed):
+    tree = random_tree(500, seed)
+    expected = [node
+                for root in tree.roots()
+                for node in recursive_dfs(tree, root)]
+    assert list(tree.iter_dfs()) == expected
+    assert len(expected) == len(tree)
+    assert sorted(tree.iter_bfs(), key=lambda node: node[0]) == sorted(expected)
+
+
+def test_deep_chain():
+    count = 50000
+    ids = [str(i) for i in range(count)]
+    tree = TocTree(ids, [None] + ids[:-1])
+    depths = [depth for _, depth in tree.iter_dfs()]
+    assert depths == list(range(count))
+    assert len(tree.ancestors(count - 1)) == count
+
+
+def test_from_source_by_id():
+    source_by_id = {
+        'r': {'id': 'r', 'parent': None, 'metadata': {}},
+        'x': {'id': 'x', 'parent': 'r',
+              'metadata': {'Microsoft.Help.TOCOrder': ['2']}},
+        'y': {'id': 'y', 'parent': 'r',
+              'metadata': {'Microsoft.Help.TOCOrder': ['1']}},
+    }
+    tree = TocTree.from_source_by_id(source_by_id)
+    assert ids_of(tree, tree.iter_dfs()) == [('r', 0), ('y', 1), ('x', 1)]
+    assert tree.roots() == [tree.index_by_id['r']]
+    assert tree.parent[tree.index_by_id['r']] == NO_NODE
+
+
+def test_get_toc_order():
+    assert get_toc_order({'Microsoft.Help.TOCOrder': ['3']}) == 3
+    assert get_toc_order({'Microsoft.Help.TOCOrder': ['x']}) == NO_ORDER
+    assert get_toc_order({}) == NO_ORDER
@@ -0,0 +1,130 @@
+import array
+import collections
+import sys
+
+
+NO_NODE = -1
+NO_ORDER = sys.maxsize
+
+
+def get_toc_order(metadata):
+    try:
+        return int(metadata['Microsoft.Help.TOCOrder'][0])
+    except (KeyError, IndexError, TypeError, ValueError):
+        return NO_ORDER
+
+
+class TocTree:
+    '''
+    Table of contents stored as parallel arrays indexed by node number.
+
+    ``parent``, ``first_child`` and ``next_sibling`` hold node indices (or
+    ``NO_NODE``); ``order`` holds the sort key used for siblings.  Nodes whose
+    parent is unknown are treated as top-level entries.
+    '''
+
+    def __init__(self, ids, parent_ids, orders=None):
+        self.ids = list(ids)
+        count = len(self.ids)
+        if orders is None:
+            orders = [NO_ORDER] * count
+
+        self.index_by_id = {id_: idx for idx, id_ in enumerate(self.ids)}
+        self.parent = array.array('l', [NO_NODE]) * count
+        self.first_child = array.array('l', [NO_NODE]) * count
+        self.next_sibling = array.array('l', [NO_NODE]) * count
+        self.order = array.array('q', orders)
+        self.first_root = NO_NODE
+
+        for idx, parent_id in enumerate(parent_ids):
+            parent_idx = self.index_by_id.get(parent_id, NO_NODE)
+            if parent_idx != idx:
+                self.parent[idx] = parent_idx
+
+        # Link in reverse sorted order, prepending each node to its parent's
+        # child list, so that siblings end up ordered by (order, id)
+        by_order = sorted(range(count),
+                          key=lambda idx: (self.order[idx], self.ids[idx]))
+        for idx in reversed(by_order):
+            parent_idx = self.parent[idx]
+            if parent_idx == NO_NODE:
+                self.next_sibling[idx] = self.first_root
+                self.first_root = idx
+            else:
+                self.next_sibling[idx] = self.first_child[parent_idx]
+                self.first_child[parent_idx] = idx
+
+    @classmethod
+    def from_source_by_id(cls, source_by_id):
+        infos = list(source_by_id.values())
+        return cls(ids=[info['id'] for info in infos],
+                   parent_ids=[info['parent'] for info in infos],
+                   orders=[get_toc_order(info['metadata']) for info in infos],
+                   )
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __repr__(self):
+        return f'<TocTree nodes={len(self)} roots={len(self.roots())}>'
+
+    def children(self, idx):
+        child = self.first_child[idx] if idx != NO_NODE else self.first_root
+        result = []
+        while child != NO_NODE:
+            result.append(child)
+            child = self.next_sibling[child]
+        return result
+
+    def roots(self):
+        return self.children(NO_NODE)
+
+    def ancestors(self, idx):
+        'Node indices from the top-level entry down to (and including) idx'
+        path = []
+        while idx != NO_NODE:
+            path.append(idx)
+            idx = self.parent[idx]
+        path.reverse()
+        return path
+
+    def iter_dfs(self, start=NO_NODE):
+        '''
+        Pre-order traversal yielding (index, depth)
+
+        Starting from ``NO_NODE`` walks every top-level entry; otherwise only
+        the subtree rooted at ``start`` is visited.
+        '''
+        node = self.first_root if start == NO_NODE else start
+        depth = 0
+
+        while node != NO_NODE:
+            yield node, depth
+            if self.first_child[node] != NO_NODE:
+                node = self.first_child[node]
+                depth += 1
+                continue
+
+            while node != NO_NODE:
+                if node == start:
+                    return
+                if self.next_sibling[node] != NO_NODE:
+                    node = self.next_sibling[node]
+                    break
+                node = self.parent[node]
+                depth -= 1
+
+    def iter_bfs(self, start=NO_NODE):
+        'Level-order traversal yielding (index, depth)'
+        if start == NO_NODE:
+            queue = collections.deque((idx, 0) for idx in self.roots())
+        else:
+            queue = collections.deque([(start, 0)])
+
+        while queue:
+            node, depth = queue.popleft()
+            yield node, depth
+            child = self.first_child[node]
+            while child != NO_NODE:
+                queue.append((child, depth + 1))
+                child = self.next_sibling[child]